@@ -6,6 +6,7 @@ import string
 
 from dotenv import load_dotenv
 from pyrogram import Client, filters, idle
+from pyrogram.errors import PeerIdInvalid, UsernameInvalid, UsernameNotOccupied
 from pyrogram.types import ChatPrivileges
 
 # ── ENV ────────────────────────────────────────────────────────────────────────
@@ -16,6 +17,7 @@ from pyrogram.types import ChatPrivileges
 #   USER_SESSION_STRING=<<< your long base64 session string >>>
 # OPTIONAL:
 #   GROUP_BASE_NAME=Escrow
+#   BOT_USERNAME_FILE=.bot_username
 # ──────────────────────────────────────────────────────────────────────────────
 load_dotenv()
 API_ID  = int(os.getenv("TG_API_ID", "0") or "0")
@@ -23,6 +25,7 @@ API_HASH = os.getenv("TG_API_HASH", "")
 BOT_TOKEN = os.getenv("BOT_TOKEN", "")
 USER_SESSION_STRING = os.getenv("USER_SESSION_STRING", "")
 GROUP_BASE_NAME = os.getenv("GROUP_BASE_NAME", "Escrow")
+BOT_USERNAME_FILE = os.getenv("BOT_USERNAME_FILE", ".bot_username")
 
 if not (API_ID and API_HASH and BOT_TOKEN):
     raise RuntimeError("Missing TG_API_ID / TG_API_HASH / BOT_TOKEN in .env")
@@ -47,24 +50,86 @@ user = Client(
 )
 
 BOT_USERNAME_CACHE = None  # filled on startup
+BOT_USER_ID = None  # bot's user id, resolved once by the USER session (see resolve_bot_user)
+_resolve_lock = asyncio.Lock()
 
 # ── UTILS ─────────────────────────────────────────────────────────────────────
+def _token_bot_id() -> str:
+    """The numeric bot id is the part of BOT_TOKEN before the colon."""
+    return BOT_TOKEN.split(":", 1)[0]
+
+def load_cached_username() -> str | None:
+    """Read the bot username saved by a previous run, if it belongs to this token."""
+    try:
+        with open(BOT_USERNAME_FILE, encoding="utf-8") as f:
+            bot_id, username = f.read().split()
+    except (OSError, ValueError):
+        return None
+    return username if bot_id == _token_bot_id() else None
+
+def save_cached_username(username: str) -> None:
+    """Persist the bot username so restarts can skip get_me()."""
+    try:
+        with open(BOT_USERNAME_FILE, "w", encoding="utf-8") as f:
+            f.write(f"{_token_bot_id()} {username}\n")
+    except OSError:
+        # Cache is best-effort; we'll just call get_me() again next time
+        pass
+
+def clear_cached_username() -> None:
+    """Drop a username cache that no longer resolves."""
+    try:
+        os.remove(BOT_USERNAME_FILE)
+    except OSError:
+        pass
+
+async def resolve_bot_user() -> int:
+    """
+    Return the bot's user id as seen by the USER session, resolving it once.
+    Uses the on-disk username cache; if that is missing or no longer resolves,
+    it is discarded and the username is fetched again with get_me().
+    """
+    global BOT_USERNAME_CACHE, BOT_USER_ID
+    async with _resolve_lock:
+        if BOT_USER_ID is not None:
+            return BOT_USER_ID
+
+        if BOT_USERNAME_CACHE is None:
+            BOT_USERNAME_CACHE = load_cached_username()
+
+        peer = None
+        if BOT_USERNAME_CACHE is not None:
+            try:
+                peer = await user.resolve_peer(BOT_USERNAME_CACHE)
+            except (UsernameNotOccupied, UsernameInvalid, PeerIdInvalid):
+                # Stale cache (bot renamed or token swapped); refetch below.
+                # Anything else (flood wait, network) propagates and keeps the cache.
+                clear_cached_username()
+                BOT_USERNAME_CACHE = None
+
+        if peer is None:
+            me = await bot.get_me()
+            BOT_USERNAME_CACHE = me.username  # without '@'
+            save_cached_username(BOT_USERNAME_CACHE)
+            peer = await user.resolve_peer(BOT_USERNAME_CACHE)
+
+        BOT_USER_ID = peer.user_id
+        return BOT_USER_ID
+
+_SUFFIX_ALPHABET = string.ascii_lowercase
+
 def generate_suffix(length: int = 5) -> str:
     """Generate random group suffix like jqbdp."""
-    import string as _s, random as _r
-    alphabet = _s.ascii_lowercase
-    return "".join(_r.choice(alphabet) for _ in range(length))
+    # Not a secret, so the non-cryptographic batch sampler is fine
+    return "".join(random.choices(_SUFFIX_ALPHABET, k=length))
 
 async def create_new_group() -> tuple[str, str, int]:
     """
     Create a brand-new supergroup via the USER session, invite the BOT,
     export an invite link, and return (invite_link, title, chat_id).
     """
-    # Ensure we know the bot username once
-    global BOT_USERNAME_CACHE
-    if not BOT_USERNAME_CACHE:
-        me = await bot.get_me()
-        BOT_USERNAME_CACHE = me.username  # without '@'
+    # Normally resolved on startup; this covers /create arriving before that
+    bot_user_id = await resolve_bot_user()
 
     # Title like: Escrow #abcde
     code = generate_suffix(5)
@@ -75,16 +140,17 @@ async def create_new_group() -> tuple[str, str, int]:
 
     # 2) Invite the BOT into the new group
     try:
-        await user.add_chat_members(chat_id=chat.id, user_ids=[f"@{BOT_USERNAME_CACHE}"])
+        await user.add_chat_members(chat_id=chat.id, user_ids=[bot_user_id])
     except Exception:
         # If already in or invite by link only, ignore
         pass
 
-    # (optional) Promote bot with basic admin powers
-    try:
-        await user.promote_chat_member(
+    # 3) Promote bot (optional) and export invite link, concurrently —
+    #    neither depends on the other once the bot is a member
+    promote_task = asyncio.create_task(
+        user.promote_chat_member(
             chat_id=chat.id,
-            user_id=f"@{BOT_USERNAME_CACHE}",
+            user_id=bot_user_id,
             privileges=ChatPrivileges(
                 can_manage_chat=True,
                 can_delete_messages=True,
@@ -96,13 +162,15 @@ async def create_new_group() -> tuple[str, str, int]:
                 can_promote_members=False,
             ),
         )
-    except Exception:
-        pass
-
-    # 3) Export invite link (multi-use)
-    try:
-        invite_link = await user.export_chat_invite_link(chat.id)
-    except Exception:
+    )
+    invite_task = asyncio.create_task(user.export_chat_invite_link(chat.id))
+    invite_link, _ = await asyncio.gather(invite_task, promote_task, return_exceptions=True)
+
+    # Promotion failures are ignored; a failed export falls back to a new link.
+    # CancelledError is a BaseException, not an Exception, so check it first.
+    if isinstance(invite_link, asyncio.CancelledError):
+        raise invite_link
+    if isinstance(invite_link, Exception):
         inv = await user.create_chat_invite_link(chat.id)
         invite_link = inv.invite_link
 
@@ -125,22 +193,20 @@ async def handle_create(_, message):
             disable_web_page_preview=True,
         )
 
-        # Post welcome + admin note inside the new group (from BOT)
+        # Post welcome + admin note inside the new group (from BOT), as one message
         await bot.send_message(
             chat_id,
             f"👋 Welcome to <b>{title}</b>!\n\n"
             f"This group has been created for your escrow transaction. "
             f"Please follow the guidelines below carefully."
-        )
-
-        await bot.send_message(
-            chat_id,
+            "\n\n——\n\n"
             "⚖️ <b>Important Notice</b> ⚖️\n\n"
             "In Wealth Escrow groups, our admins @mruppy and @cheflatto can join at any time to ensure everything "
             "runs smoothly and securely. While our escrow process is fully automated through the bot, we also have "
             "active manual monitoring to keep transactions safe.\n\n"
             "🚨 <b>Important:</b> Escrow groups are only for depositing and releasing payments. "
-            "All product discussions and deliveries should be handled privately in DMs."
+            "All product discussions and deliveries should be handled privately in DMs.",
+            disable_web_page_preview=True,
         )
 
     except Exception as e:
@@ -157,17 +223,14 @@ async def main():
     await user.start()
     await bot.start()
 
-    # Cache bot username (used when inviting)
-    global BOT_USERNAME_CACHE
-    me = await bot.get_me()
-    BOT_USERNAME_CACHE = me.username
+    # Resolve the bot once (username cached on disk across restarts)
+    await resolve_bot_user()
 
     print("Bot is running...")
     await idle()  # keep both running
 
-    # Graceful shutdown
-    await bot.stop()
-    await user.stop()
+    # Graceful shutdown (clients are independent, stop them together)
+    await asyncio.gather(bot.stop(), user.stop())
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -3,64 +3,82 @@ import os
 import asyncio
 import io
 import random
+import contextlib
 from aiogram import Bot, Dispatcher, types
 from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup, BotCommand
 from aiogram.utils import executor
-from dotenv import load_dotenv
-import qrcode
-import requests
+from aiogram.utils.exceptions import RetryAfter
+from aiolimiter import AsyncLimiter
+from btcpay import close_session, get_invoice, invoice_qr
+import aiosqlite
+from cachetools import TTLCache
+from common import TOPIC_IDS
 
 # ---------------------- Load environment ----------------------
-load_dotenv()
-
+# .env is loaded by common
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 GROUP_CHAT_ID = int(os.getenv("GROUP_CHAT_ID", "0"))
-TOPIC_IDS = [int(t.strip()) for t in os.getenv("TOPIC_IDS", "").split(",") if t.strip()]
 
-BTCPAY_URL = os.getenv("BTCPAY_URL", "https://mainnet.demo.btcpayserver.org").rstrip("/")
-BTCPAY_API_KEY = os.getenv("BTCPAY_API_KEY")
-BTCPAY_STORE_ID = os.getenv("BTCPAY_STORE_ID")
+ROLES_DB_PATH = os.getenv("ROLES_DB_PATH", "roles.db")
 
 bot = Bot(token=BOT_TOKEN, parse_mode="HTML")
 dp = Dispatcher(bot)
 
-# In-memory store for registered users
-user_roles = {}  # {user_id: {"role": "seller"/"buyer", "address": "wallet"}}
+# SQLite store for registered users (opened in on_startup, closed in on_shutdown)
+_db = None  # roles(user_id, role "seller"/"buyer", address "wallet")
+
+
+# ---------------------- Role Storage ----------------------
+async def set_user_role(user_id: int, role: str, address: str):
+    await _db.execute("INSERT OR REPLACE INTO roles VALUES (?, ?, ?)", (user_id, role, address))
+    await _db.commit()
 
 
-# ---------------------- BTCPay Helpers ----------------------
-def _headers():
-    return {"Authorization": f"token {BTCPAY_API_KEY}", "Content-Type": "application/json"}
+# ---------------------- Outgoing Rate Limit ----------------------
+# Telegram allows ~30 msg/s bot-wide and 20 msg/min per group; stay under both
+GLOBAL_LIMIT = AsyncLimiter(25, 1)
+# Per-group limiters, dropped once a group has been idle for a couple of minutes
+CHAT_LIMIT = TTLCache(maxsize=10_000, ttl=120)
 
 
-def _store_base_url():
-    return f"{BTCPAY_URL}/api/v1/stores/{BTCPAY_STORE_ID}"
+def _group_limiter(chat_id: int):
+    limiter = CHAT_LIMIT.get(chat_id)
+    if limiter is None:
+        limiter = AsyncLimiter(18, 60)
+    CHAT_LIMIT[chat_id] = limiter  # re-insert to refresh the TTL while active
+    return limiter
 
 
-def get_invoice(invoice_id: str):
-    url = f"{_store_base_url()}/invoices/{invoice_id}"
-    resp = requests.get(url, headers=_headers(), timeout=30)
-    resp.raise_for_status()
-    return resp.json()
+async def _send_limited(chat_id: int, coro_factory):
+    # The per-minute limit only applies to groups (negative chat ids)
+    chat_limit = _group_limiter(chat_id) if chat_id < 0 else contextlib.nullcontext()
+    async with chat_limit, GLOBAL_LIMIT:
+        return await coro_factory()
+
+
+async def safe_send(chat_id: int, coro_factory):
+    """Run an outgoing API call within the rate limits, retrying once on flood wait."""
+    try:
+        return await _send_limited(chat_id, coro_factory)
+    except RetryAfter as e:
+        # The retry is a new request, so it takes fresh limiter tokens
+        await asyncio.sleep(e.timeout)
+        return await _send_limited(chat_id, coro_factory)
 
 
-def generate_payment_qr(invoice_id: str) -> io.BytesIO:
-    inv = get_invoice(invoice_id)
-    pm = inv.get("checkout", {}).get("paymentMethods", [])
-    if not pm:
-        raise ValueError("No payment methods in invoice")
+# ---------------------- Auto-delete ----------------------
+# Strong references so pending delete tasks aren't garbage-collected
+_background_tasks = set()
 
-    address = pm[0].get("destination")
-    amount = pm[0].get("amount")
-    uri = f"bitcoin:{address}"
-    if amount:
-        uri += f"?amount={amount}"
 
-    img = qrcode.make(uri)
-    buf = io.BytesIO()
-    img.save(buf, format="PNG")
-    buf.seek(0)
-    return buf
+async def _delayed_delete(*messages: types.Message, delay: float = 60):
+    await asyncio.sleep(delay)
+    for m in messages:
+        try:
+            await m.delete()
+        except Exception:
+            # Already deleted or we lack rights; nothing to do
+            pass
 
 
 # ---------------------- Group Invite ----------------------
@@ -76,127 +94,142 @@ async def generate_group_invite():
     return invite.invite_link
 
 
+# ---------------------- Static Messages ----------------------
+_START_KEYBOARD = InlineKeyboardMarkup(row_width=2)
+_START_KEYBOARD.add(
+    InlineKeyboardButton("💬 INSTRUCTIONS", url="https://t.me/WealthEscrow/11"),
+    InlineKeyboardButton("📜 TERMS", url="https://t.me/WealthEscrow/12"),
+)
+_START_KEYBOARD.add(
+    InlineKeyboardButton("⚡️ CREATE ESCROW GROUP", callback_data="create_group"),
+)
+
+_WELCOME_TEXT = (
+    "⚜️ <b>WealthEscrowBot</b> ⚜️ v.1\n"
+    "Your Automated Telegram Escrow Service\n\n"
+    "Welcome to WealthEscrowBot! This bot provides a secure escrow service for your transactions on Telegram. "
+    "🔒 No more worries about getting scammed—your funds stay safe during all your deals.\n\n"
+    "⏳ If you run into any issues, just type <b>/contact</b>, and an arbitrator will join your group chat within 24 hours.\n\n"
+    "💰 <b>ESCROW FEE:</b>\n"
+    "• 5% for amounts over $100\n"
+    "• $5 for amounts under $100\n\n"
+    "🌟 <a href='https://t.me/WealthEscrow'>UPDATES</a> - "
+    "<a href='https://t.me/WealthEscrowBotVouches'>VOUCHES</a>\n"
+    "✅ DEALS COMPLETED: 4371\n"
+    "⚖️ DISPUTES RESOLVED: 162\n\n"
+    "🛒 To declare yourself as a seller or buyer:\n"
+    "• Type <code>/seller ADDRESS</code> to register as a seller.\n"
+    "• Type <code>/buyer ADDRESS</code> to register as a buyer.\n"
+    "• Or simply paste your crypto address and choose your role using the buttons.\n\n"
+    "💡 Replace ADDRESS with your BTC, LTC, USDT (TRC20), USDT (BEP20), or TON wallet address.\n\n"
+    "📜 Type /menu to view all the bot's features. (only works inside escrow groups)"
+)
+
+_MENU_TEXT = (
+    "📜 <b>Bot Menu</b>\n\n"
+    "/whatisescrow - Explains escrow\n"
+    "/video - Sends bot working video\n"
+    "/balance - Show escrow balance\n"
+    "/pay_seller - Releases money to seller\n"
+    "/refund_buyer - Releases money to buyer\n"
+    "/qr - Show address QR\n"
+    "/blockchain - Show blockchain link of address\n"
+    "/contact - Contact an admin in case of dispute\n"
+    "/real - Check if admin is real\n"
+    "/review - To leave a review\n"
+    "/userinfo - Get detailed escrow stats\n"
+    "/leaderboard - View Top Users\n"
+    "/refer - Refer users and earn USDT bonuses\n"
+    "/setpin - Set Transaction PIN\n"
+)
+
+
 # ---------------------- Commands ----------------------
 @dp.message_handler(commands=["start"])
 async def cmd_start(message: types.Message):
-    keyboard = InlineKeyboardMarkup(row_width=2)
-    keyboard.add(
-        InlineKeyboardButton("💬 INSTRUCTIONS", url="https://t.me/WealthEscrow/11"),
-        InlineKeyboardButton("📜 TERMS", url="https://t.me/WealthEscrow/12"),
-    )
-    keyboard.add(
-        InlineKeyboardButton("⚡️ CREATE ESCROW GROUP", callback_data="create_group"),
-    )
-
-    welcome = (
-        "⚜️ <b>WealthEscrowBot</b> ⚜️ v.1\n"
-        "Your Automated Telegram Escrow Service\n\n"
-        "Welcome to WealthEscrowBot! This bot provides a secure escrow service for your transactions on Telegram. "
-        "🔒 No more worries about getting scammed—your funds stay safe during all your deals.\n\n"
-        "⏳ If you run into any issues, just type <b>/contact</b>, and an arbitrator will join your group chat within 24 hours.\n\n"
-        "💰 <b>ESCROW FEE:</b>\n"
-        "• 5% for amounts over $100\n"
-        "• $5 for amounts under $100\n\n"
-        "🌟 <a href='https://t.me/WealthEscrow'>UPDATES</a> - "
-        "<a href='https://t.me/WealthEscrowBotVouches'>VOUCHES</a>\n"
-        "✅ DEALS COMPLETED: 4371\n"
-        "⚖️ DISPUTES RESOLVED: 162\n\n"
-        "🛒 To declare yourself as a seller or buyer:\n"
-        "• Type <code>/seller ADDRESS</code> to register as a seller.\n"
-        "• Type <code>/buyer ADDRESS</code> to register as a buyer.\n"
-        "• Or simply paste your crypto address and choose your role using the buttons.\n\n"
-        "💡 Replace ADDRESS with your BTC, LTC, USDT (TRC20), USDT (BEP20), or TON wallet address.\n\n"
-        "📜 Type /menu to view all the bot's features. (only works inside escrow groups)"
-    )
-
-    await message.answer(welcome, reply_markup=keyboard, parse_mode="HTML")
+    await safe_send(message.chat.id, lambda: message.answer(_WELCOME_TEXT, reply_markup=_START_KEYBOARD, parse_mode="HTML"))
 
 
 @dp.callback_query_handler(lambda c: c.data == "create_group")
 async def callback_create_group(call: types.CallbackQuery):
     invite = await generate_group_invite()
-    await call.message.answer(f"⚡ Here is your private escrow group link:\n{invite}")
+    await safe_send(call.message.chat.id, lambda: call.message.answer(f"⚡ Here is your private escrow group link:\n{invite}"))
 
 
 @dp.message_handler(commands=["create"])
 async def cmd_create(message: types.Message):
     invite = await generate_group_invite()
-    await message.answer(f"⚡ Here is your private escrow group link:\n{invite}")
+    await safe_send(message.chat.id, lambda: message.answer(f"⚡ Here is your private escrow group link:\n{invite}"))
 
 
 @dp.message_handler(commands=["pay"])
 async def cmd_pay(message: types.Message):
-    parts = message.text.split()
+    # Only the first token after the command is used
+    parts = message.text.split(maxsplit=2)
     if len(parts) < 2:
-        await message.reply("⚠️ Usage: /pay <invoice_id>")
+        await safe_send(message.chat.id, lambda: message.reply("⚠️ Usage: /pay <invoice_id>"))
         return
 
     invoice_id = parts[1]
     try:
-        inv = get_invoice(invoice_id)
+        inv = await get_invoice(invoice_id)
         checkout_url = inv.get("checkoutLink")
-        qr_buf = generate_payment_qr(invoice_id)
+        png, _ = await invoice_qr(inv)
 
-        msg = await message.answer_photo(
-            types.InputFile(qr_buf, filename="qr.png"),
+        msg = await safe_send(message.chat.id, lambda: message.answer_photo(
+            types.InputFile(io.BytesIO(png), filename="qr.png"),
             caption=f"💳 <b>Invoice Payment</b>\n"
                     f"ID: <code>{invoice_id}</code>\n\n"
                     f"Pay here: {checkout_url}\n\n"
                     f"(This message will auto-delete in 60s)"
-        )
+        ))
 
-        await asyncio.sleep(60)
-        await msg.delete()
-        await message.delete()
+        # Delete in the background so the handler returns immediately
+        task = asyncio.create_task(_delayed_delete(msg, message))
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
     except Exception as e:
-        await message.reply(f"❌ Error: {e}")
+        await safe_send(message.chat.id, lambda: message.reply(f"❌ Error: {e}"))
 
 
 @dp.message_handler(commands=["menu"])
 async def cmd_menu(message: types.Message):
-    text = (
-        "📜 <b>Bot Menu</b>\n\n"
-        "/whatisescrow - Explains escrow\n"
-        "/video - Sends bot working video\n"
-        "/balance - Show escrow balance\n"
-        "/pay_seller - Releases money to seller\n"
-        "/refund_buyer - Releases money to buyer\n"
-        "/qr - Show address QR\n"
-        "/blockchain - Show blockchain link of address\n"
-        "/contact - Contact an admin in case of dispute\n"
-        "/real - Check if admin is real\n"
-        "/review - To leave a review\n"
-        "/userinfo - Get detailed escrow stats\n"
-        "/leaderboard - View Top Users\n"
-        "/refer - Refer users and earn USDT bonuses\n"
-        "/setpin - Set Transaction PIN\n"
-    )
-    await message.answer(text, parse_mode="HTML")
+    await safe_send(message.chat.id, lambda: message.answer(_MENU_TEXT, parse_mode="HTML"))
 
 
 # ---------------------- Seller / Buyer ----------------------
 @dp.message_handler(commands=["seller"])
 async def cmd_seller(message: types.Message):
-    parts = message.text.split()
+    # Only the first token after the command is used
+    parts = message.text.split(maxsplit=2)
     if len(parts) < 2:
-        await message.reply("⚠️ Usage: /seller <WALLET_ADDRESS>")
+        await safe_send(message.chat.id, lambda: message.reply("⚠️ Usage: /seller <WALLET_ADDRESS>"))
         return
 
     wallet = parts[1]
-    user_roles[message.from_user.id] = {"role": "seller", "address": wallet}
-    await message.reply(f"✅ You are now registered as a <b>SELLER</b>.\nWallet: <code>{wallet}</code>", parse_mode="HTML")
+    try:
+        await set_user_role(message.from_user.id, "seller", wallet)
+    except aiosqlite.Error:
+        await safe_send(message.chat.id, lambda: message.reply("❌ Could not save your registration. Please try again."))
+        return
+    await safe_send(message.chat.id, lambda: message.reply(f"✅ You are now registered as a <b>SELLER</b>.\nWallet: <code>{wallet}</code>", parse_mode="HTML"))
 
 
 @dp.message_handler(commands=["buyer"])
 async def cmd_buyer(message: types.Message):
-    parts = message.text.split()
+    # Only the first token after the command is used
+    parts = message.text.split(maxsplit=2)
     if len(parts) < 2:
-        await message.reply("⚠️ Usage: /buyer <WALLET_ADDRESS>")
+        await safe_send(message.chat.id, lambda: message.reply("⚠️ Usage: /buyer <WALLET_ADDRESS>"))
         return
 
     wallet = parts[1]
-    user_roles[message.from_user.id] = {"role": "buyer", "address": wallet}
-    await message.reply(f"✅ You are now registered as a <b>BUYER</b>.\nWallet: <code>{wallet}</code>", parse_mode="HTML")
+    try:
+        await set_user_role(message.from_user.id, "buyer", wallet)
+    except aiosqlite.Error:
+        await safe_send(message.chat.id, lambda: message.reply("❌ Could not save your registration. Please try again."))
+        return
+    await safe_send(message.chat.id, lambda: message.reply(f"✅ You are now registered as a <b>BUYER</b>.\nWallet: <code>{wallet}</code>", parse_mode="HTML"))
 
 
 # ---------------------- Register Bot Commands ----------------------
@@ -225,9 +258,21 @@ async def set_bot_commands(bot: Bot):
 
 # ---------------------- Startup ----------------------
 async def on_startup(dp):
+    global _db
+    _db = await aiosqlite.connect(ROLES_DB_PATH)
+    await _db.execute(
+        "CREATE TABLE IF NOT EXISTS roles(user_id INTEGER PRIMARY KEY, role TEXT, address TEXT)"
+    )
+    await _db.commit()
     await set_bot_commands(bot)
     print("✅ WealthEscrowBot started...")
 
 
+async def on_shutdown(dp):
+    await close_session()
+    if _db is not None:
+        await _db.close()
+
+
 if __name__ == "__main__":
-    executor.start_polling(dp, on_startup=on_startup)
+    executor.start_polling(dp, on_startup=on_startup, on_shutdown=on_shutdown)
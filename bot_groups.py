@@ -1,27 +1,19 @@
 # bot_groups.py
 import os
 import random
-import io
-import requests
-import qrcode
-from dotenv import load_dotenv
+from btcpay import close_session, payment_qr
+from common import TOPIC_IDS
 from aiogram import Bot, Dispatcher, F, types
-from aiogram.types import FSInputFile, Message
-from aiogram.filters import Command
+from aiogram.types import BufferedInputFile, Message
+from aiogram.filters import Command, CommandObject
 from aiogram.enums import ParseMode
 from aiogram import Router
 
 # -------------------------------------------------------------------
-# Load environment variables
+# Load environment variables (.env is loaded by common)
 # -------------------------------------------------------------------
-load_dotenv()
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 GROUP_CHAT_ID = int(os.getenv("GROUP_CHAT_ID", "0"))
-TOPIC_IDS = [int(t.strip()) for t in os.getenv("TOPIC_IDS", "").split(",") if t.strip()]
-
-BTCPAY_URL = (os.getenv("BTCPAY_URL", "https://mainnet.demo.btcpayserver.org").rstrip("/"))
-BTCPAY_API_KEY = os.getenv("BTCPAY_API_KEY")
-BTCPAY_STORE_ID = os.getenv("BTCPAY_STORE_ID")
 
 if not BOT_TOKEN:
     raise RuntimeError("❌ Missing BOT_TOKEN in .env")
@@ -30,73 +22,12 @@ bot = Bot(token=BOT_TOKEN)
 dp = Dispatcher()
 
 # -------------------------------------------------------------------
-# BTCPay helper functions
+# Startup / shutdown
 # -------------------------------------------------------------------
 
-def _headers():
-    if not BTCPAY_API_KEY or not BTCPAY_STORE_ID:
-        raise RuntimeError("❌ Missing BTCPAY_API_KEY or BTCPAY_STORE_ID in .env")
-    return {
-        "Authorization": f"token {BTCPAY_API_KEY}",
-        "Content-Type": "application/json",
-    }
-
-def _store_base_url() -> str:
-    return f"{BTCPAY_URL}/api/v1/stores/{BTCPAY_STORE_ID}"
-
-def create_invoice(escrow_id: str, amount: float, currency: str = "USD") -> dict:
-    url = f"{_store_base_url()}/invoices"
-    payload = {
-        "amount": str(amount),
-        "currency": currency,
-        "metadata": {"escrow_id": escrow_id},
-    }
-    resp = requests.post(url, json=payload, headers=_headers(), timeout=30)
-    resp.raise_for_status()
-    return resp.json()
-
-def get_invoice(invoice_id: str) -> dict:
-    url = f"{_store_base_url()}/invoices/{invoice_id}"
-    resp = requests.get(url, headers=_headers(), timeout=30)
-    resp.raise_for_status()
-    return resp.json()
-
-def generate_payment_qr(invoice_id: str, prefer_lightning: bool = False) -> tuple[io.BytesIO, str]:
-    """
-    Return (qr_buffer, payment_uri) for BTC or LN based on preference.
-    """
-    inv = get_invoice(invoice_id)
-
-    methods = inv.get("checkout", {}).get("paymentMethods", [])
-    if not methods:
-        raise ValueError("No payment methods found in invoice.")
-
-    chosen = None
-    if prefer_lightning:
-        for m in methods:
-            if "Lightning" in m.get("paymentMethod", ""):
-                chosen = m
-                break
-    if not chosen:
-        chosen = methods[0]
-
-    address = chosen.get("destination")
-    if not address:
-        raise ValueError("No payment destination found.")
-
-    amount = chosen.get("amount")
-    if "Lightning" in chosen.get("paymentMethod", ""):
-        uri = f"lightning:{address}"
-    else:
-        uri = f"bitcoin:{address}"
-        if amount:
-            uri += f"?amount={amount}"
-
-    img = qrcode.make(uri)
-    buf = io.BytesIO()
-    img.save(buf, format="PNG")
-    buf.seek(0)
-    return buf, uri
+@dp.shutdown()
+async def on_shutdown():
+    await close_session()
 
 # -------------------------------------------------------------------
 # Bot commands
@@ -120,26 +51,22 @@ async def cmd_create(message: Message):
     await message.reply(f"✅ Invite link created for topic {topic_id}:\n{invite.invite_link}")
 
 @dp.message(Command("pay"))
-async def cmd_pay(message: Message):
+async def cmd_pay(message: Message, command: CommandObject):
     """
     Generate and send a QR code for a BTCPay invoice.
     Usage: /pay <invoice_id>
     """
-    args = message.text.strip().split()
-    if len(args) < 2:
+    args = (command.args or "").split(maxsplit=1)
+    if not args:
         await message.reply("⚠️ Usage: /pay <invoice_id>")
         return
 
-    invoice_id = args[1]
+    invoice_id = args[0]
 
     try:
-        qr_buf, uri = generate_payment_qr(invoice_id, prefer_lightning=False)
-
-        tmp_file = f"/tmp/{invoice_id}.png"
-        with open(tmp_file, "wb") as f:
-            f.write(qr_buf.read())
+        png, uri = await payment_qr(invoice_id, prefer_lightning=False)
 
-        photo = FSInputFile(tmp_file)
+        photo = BufferedInputFile(png, filename=f"{invoice_id}.png")
         await message.reply_photo(
             photo,
             caption=f"💳 Payment QR for invoice `{invoice_id}`\n\n👉 URI: `{uri}`",
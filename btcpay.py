@@ -16,21 +16,45 @@ Notes
 """
 from __future__ import annotations
 
+import asyncio
 import os
-from typing import Any, Dict, Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Optional, Tuple
 import io
 
-import requests
-import qrcode
-from dotenv import load_dotenv
+import aiohttp
+import orjson
+import segno
+from cachetools import LRUCache, TTLCache
 
-load_dotenv()
+import common  # noqa: F401  (loads .env)
 
 # Load from environment variables
 BTCPAY_URL = (os.getenv("BTCPAY_URL", "https://mainnet.demo.btcpayserver.org").rstrip("/"))
 BTCPAY_API_KEY = os.getenv("BTCPAY_API_KEY")
 BTCPAY_STORE_ID = os.getenv("BTCPAY_STORE_ID")
 
+# Worker threads for QR rendering, kept off the event loop
+QR_EXECUTOR = ThreadPoolExecutor(max_workers=4)
+
+# Rendered PNGs by payment URI. URIs are stable for the life of an invoice,
+# so repeat renders are served from here without touching QR_EXECUTOR.
+_QR_CACHE: LRUCache = LRUCache(maxsize=512)
+
+# Shared HTTP session, created lazily inside the running event loop
+_session: Optional[aiohttp.ClientSession] = None
+
+# Short-lived invoice cache to collapse bursts of status polling.
+# Terminal statuses are never cached (see get_invoice).
+_INV_CACHE: TTLCache = TTLCache(maxsize=2048, ttl=2.0)
+_TERMINAL_STATUSES = ("Settled", "Expired", "Invalid")
+_INFLIGHT: Dict[str, asyncio.Task] = {}
+
+# Transient gateway and connection errors are retried on idempotent GETs
+_RETRY_STATUSES = (502, 503, 504)
+_RETRY_ATTEMPTS = 3
+_RETRY_BACKOFF = 0.2
+
 
 # --------------------------- Internal helpers ---------------------------
 
@@ -61,9 +85,48 @@ def _store_base_url() -> str:
     return f"{BTCPAY_URL}/api/v1/stores/{BTCPAY_STORE_ID}"
 
 
+def _get_session() -> aiohttp.ClientSession:
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=50,
+                limit_per_host=20,
+                use_dns_cache=True,
+                ttl_dns_cache=300,
+                keepalive_timeout=75,
+            ),
+            timeout=aiohttp.ClientTimeout(total=30),
+        )
+    return _session
+
+
+async def close_session() -> None:
+    """Close the shared HTTP session. Call this from your bot's shutdown hook."""
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+
+async def _get_json(url: str) -> Dict[str, Any]:
+    for attempt in range(_RETRY_ATTEMPTS + 1):
+        last = attempt == _RETRY_ATTEMPTS
+        try:
+            async with _get_session().get(url, headers=_headers()) as resp:
+                if last or resp.status not in _RETRY_STATUSES:
+                    resp.raise_for_status()
+                    return await resp.json(loads=orjson.loads)
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+            if last:
+                raise
+        # Back off only after the response (and its connection) is released
+        await asyncio.sleep(_RETRY_BACKOFF * 2 ** attempt)
+
+
 # ------------------------------- Public API ------------------------------
 
-def create_invoice(
+async def create_invoice(
     escrow_id: str,
     amount: float,
     currency: str = "USD",
@@ -78,51 +141,112 @@ def create_invoice(
     if buyer_email:
         payload["metadata"]["buyerEmail"] = buyer_email
 
-    resp = requests.post(url, json=payload, headers=_headers(), timeout=30)
-    resp.raise_for_status()
-    return resp.json()
+    async with _get_session().post(url, json=payload, headers=_headers()) as resp:
+        resp.raise_for_status()
+        return await resp.json(loads=orjson.loads)
 
 
-def get_invoice(invoice_id: str) -> Dict[str, Any]:
-    url = f"{_store_base_url()}/invoices/{invoice_id}"
-    resp = requests.get(url, headers=_headers(), timeout=30)
-    resp.raise_for_status()
-    return resp.json()
+async def _fetch_invoice(invoice_id: str) -> Dict[str, Any]:
+    try:
+        url = f"{_store_base_url()}/invoices/{invoice_id}"
+        data = await _get_json(url)
+        if data.get("status") not in _TERMINAL_STATUSES:
+            _INV_CACHE[invoice_id] = data
+        return data
+    finally:
+        _INFLIGHT.pop(invoice_id, None)
 
 
-def is_invoice_paid(invoice_id: str) -> bool:
-    inv = get_invoice(invoice_id)
-    return inv.get("status") == "Settled"
+async def get_invoice(invoice_id: str) -> Dict[str, Any]:
+    cached = _INV_CACHE.get(invoice_id)
+    if cached is not None:
+        return cached
 
+    # Concurrent callers share one fetch task. Each caller awaits it through
+    # shield(), so a cancelled caller stops waiting without cancelling the
+    # fetch for everyone else.
+    task = _INFLIGHT.get(invoice_id)
+    if task is None:
+        task = asyncio.create_task(_fetch_invoice(invoice_id))
+        # Retrieve the error even if every caller was cancelled, to avoid
+        # "Task exception was never retrieved" warnings
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        _INFLIGHT[invoice_id] = task
+    return await asyncio.shield(task)
 
-def generate_payment_qr(invoice_id: str) -> io.BytesIO:
-    """
-    Generate a QR code PNG for the first crypto payment address of an invoice.
-    Returns a BytesIO object that you can send directly in your bot.
-    """
-    inv = get_invoice(invoice_id)
 
-    # Extract payment address from first crypto method
-    pm = inv.get("checkout", {}).get("paymentMethods", [])
-    if not pm:
+async def is_invoice_paid(invoice_id: str) -> bool:
+    inv = await get_invoice(invoice_id)
+    return inv.get("status") == "Settled"
+
+
+def _payment_uri(inv: Dict[str, Any], prefer_lightning: bool = False) -> str:
+    methods = inv.get("checkout", {}).get("paymentMethods", [])
+    if not methods:
         raise ValueError("No payment methods found in invoice.")
 
-    address = pm[0].get("destination")
+    chosen = None
+    if prefer_lightning:
+        chosen = next((m for m in methods if "Lightning" in m.get("paymentMethod", "")), None)
+    if chosen is None:
+        chosen = methods[0]
+
+    address = chosen.get("destination")
     if not address:
         raise ValueError("No payment address found in invoice.")
 
+    if "Lightning" in chosen.get("paymentMethod", ""):
+        return f"lightning:{address}"
+
     # Encode as Bitcoin URI (BIP21 style)
-    amount = pm[0].get("amount")
+    amount = chosen.get("amount")
     uri = f"bitcoin:{address}"
     if amount:
         uri += f"?amount={amount}"
+    return uri
+
 
-    # Generate QR code into memory
-    img = qrcode.make(uri)
+def _render_qr_png(uri: str) -> bytes:
+    # make_qr rather than make: short URIs would otherwise become Micro QR codes,
+    # which most wallet scanners cannot read.
+    qr = segno.make_qr(uri, error="l")
     buf = io.BytesIO()
-    img.save(buf, format="PNG")
-    buf.seek(0)
-    return buf
+    qr.save(buf, kind="png", scale=6, border=2)
+    return buf.getvalue()
+
+
+async def invoice_qr(inv: Dict[str, Any], prefer_lightning: bool = False) -> Tuple[bytes, str]:
+    """
+    Generate a QR code PNG for an already-fetched invoice's payment address.
+    Uses the first Lightning method if prefer_lightning is set, otherwise the
+    first crypto method. Returns (png_bytes, payment_uri).
+    """
+    uri = _payment_uri(inv, prefer_lightning)
+    # Cache hits are answered on the event loop; only misses go to a worker
+    png = _QR_CACHE.get(uri)
+    if png is None:
+        loop = asyncio.get_running_loop()
+        png = await loop.run_in_executor(QR_EXECUTOR, _render_qr_png, uri)
+        _QR_CACHE[uri] = png
+    return png, uri
+
+
+async def payment_qr(invoice_id: str, prefer_lightning: bool = False) -> Tuple[bytes, str]:
+    """
+    Fetch an invoice and generate its payment QR code (see invoice_qr).
+    Returns (png_bytes, payment_uri).
+    """
+    inv = await get_invoice(invoice_id)
+    return await invoice_qr(inv, prefer_lightning)
+
+
+async def generate_payment_qr(invoice_id: str, prefer_lightning: bool = False) -> io.BytesIO:
+    """
+    Generate a QR code PNG for the first crypto payment address of an invoice.
+    Returns a BytesIO object that you can send directly in your bot.
+    """
+    png, _ = await payment_qr(invoice_id, prefer_lightning)
+    return io.BytesIO(png)
 
 
 # ------------------------------ Dry-run tests -----------------------------
@@ -1,10 +1,12 @@
 import os
 from dotenv import load_dotenv
 
-load_dotenv()  # load from .env
+REQUIRED = ("BOT_TOKEN", "ADMIN_ID", "BTCPAY_API_KEY", "TG_API_ID", "TG_API_HASH")
 
-print("BOT_TOKEN:", os.getenv("BOT_TOKEN"))
-print("ADMIN_ID:", os.getenv("ADMIN_ID"))
-print("BTCPAY_API_KEY:", os.getenv("BTCPAY_API_KEY"))
-print("TG_API_ID:", os.getenv("TG_API_ID"))
-print("TG_API_HASH:", os.getenv("TG_API_HASH"))
+if __name__ == "__main__":
+    load_dotenv()  # load from .env
+
+    missing = [k for k in REQUIRED if not os.getenv(k)]
+    if missing:
+        raise SystemExit(f"Missing: {missing}")
+    print("All env vars present")
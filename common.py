@@ -0,0 +1,16 @@
+# common.py
+"""
+Settings shared by bot.py, bot_groups.py and btcpay.py.
+
+Importing this module loads .env once, so importers don't each need
+to call load_dotenv() and re-parse the same variables.
+"""
+import os
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+TOPIC_IDS: tuple[int, ...] = tuple(
+    int(t.strip()) for t in os.getenv("TOPIC_IDS", "").split(",") if t.strip()
+)